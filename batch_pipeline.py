@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Batched image-to-image generation shared by the CLI and web interfaces
+Developed by Tarun Agarwal for Prodigy InfoTech
+"""
+
+import json
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+from PIL import Image
+
+from config.settings import MODEL_CONFIGS
+from utils.image_utils import save_image
+
+RESULTS_DIR = Path("results")
+
+def fit_resolution(image: Image.Image, max_resolution: int) -> Image.Image:
+    """Scale an image down to fit max_resolution, with both sides a multiple of 8 for the VAE."""
+    scale = min(1.0, max_resolution / max(image.size))
+    size = (max(8, int(image.width * scale) // 8 * 8), max(8, int(image.height * scale) // 8 * 8))
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+    return image
+
+def reserve_output_path(source_stem: str, model_name: str, prompt: str) -> Path:
+    """
+    Claim a results path named <source>_<model>_<prompt>_<timestamp>.png.
+    
+    The file is created empty so no other writer can take the same name;
+    inputs sharing a stem (a.jpg, a.png) get _2, _3, ... suffixes.
+    """
+    RESULTS_DIR.mkdir(exist_ok=True)
+    slug = re.sub(r'\W+', '_', prompt.lower()).strip('_')[:50] or 'untitled'
+    base = f"{source_stem}_{model_name}_{slug}_{datetime.now():%Y%m%d_%H%M%S}"
+    attempt = 1
+    while True:
+        path = RESULTS_DIR / (f"{base}.png" if attempt == 1 else f"{base}_{attempt}.png")
+        try:
+            path.open('x').close()
+            return path
+        except FileExistsError:
+            attempt += 1
+
+def save_result(image: Image.Image, path: Path, metadata: dict):
+    """Write a generated image and its JSON metadata sidecar, leaving neither behind on failure."""
+    try:
+        save_image(image, str(path), metadata=metadata)
+        path.with_suffix('.json').write_text(json.dumps(metadata, indent=2, default=str))
+    except Exception:
+        path.unlink(missing_ok=True)
+        path.with_suffix('.json').unlink(missing_ok=True)
+        raise
+
+def generate_batch(generator, images: List[Image.Image], prompts: List[str],
+                   strength: float, guidance_scale: float, num_inference_steps: int) -> List[dict]:
+    """
+    Generate several images with one pipeline call per distinct input size.
+
+    Returns result dicts shaped like ImageGenerator.generate()'s, in input
+    order. Nothing is written to disk; outputs carry no output_path.
+    """
+    import torch
+
+    max_resolution = MODEL_CONFIGS[generator.model_name]['max_resolution']
+    inputs = [fit_resolution(image.convert("RGB"), max_resolution) for image in images]
+
+    # Latents only stack when every image in a call has the same size
+    groups = {}
+    for index, image in enumerate(inputs):
+        groups.setdefault(image.size, []).append(index)
+
+    results = [None] * len(inputs)
+    for indices in groups.values():
+        start_time = time.time()
+        try:
+            with torch.inference_mode():
+                outputs = generator.pipe(
+                    prompt=[prompts[i] for i in indices],
+                    image=[inputs[i] for i in indices],
+                    strength=strength,
+                    guidance_scale=guidance_scale,
+                    num_inference_steps=num_inference_steps
+                ).images
+        except Exception as e:
+            for i in indices:
+                results[i] = {"success": False, "error": str(e)}
+            continue
+        generation_time = time.time() - start_time
+
+        for i, output in zip(indices, outputs):
+            results[i] = {
+                "success": True,
+                "generated_image": output,
+                "metadata": {
+                    "model": generator.model_name,
+                    "prompt": prompts[i],
+                    "generation_time": generation_time,
+                    "strength": strength,
+                    "guidance_scale": guidance_scale,
+                    "num_inference_steps": num_inference_steps,
+                    "device": str(generator.pipe.device),
+                    "input_size": images[i].size,
+                    "output_size": output.size,
+                    "batch_size": len(indices)
+                }
+            }
+    return results
\ No newline at end of file
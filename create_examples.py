@@ -4,18 +4,15 @@ Create sample images for demo examples
 Developed by Tarun Agarwal for Prodigy InfoTech
 """
 
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from pathlib import Path
 
-def create_sample_images():
-    """Create sample images for the demo examples."""
-    
-    # Create examples directory
-    examples_dir = Path("examples")
-    examples_dir.mkdir(exist_ok=True)
-    
-    # Sample 1: Landscape
+# Demo fixtures only need to look right: 4:2:0 chroma at quality 85 halves
+# the chroma DCT work and file size versus quality 95 with no visible change
+JPEG_OPTIONS = dict(format="JPEG", quality=85, subsampling=2, optimize=False, progressive=False)
+
+def _build_landscape(path: Path):
+    """Sample 1: landscape with mountains, sun and trees."""
     print("Creating sample landscape image...")
     landscape = Image.new('RGB', (512, 384), (135, 206, 235))  # Sky blue
     draw = ImageDraw.Draw(landscape)
@@ -34,10 +31,11 @@ def create_sample_images():
         draw.ellipse([(x-15, 200), (x+15, 230)], fill=(0, 100, 0))
         draw.rectangle([(x-5, 230), (x+5, 250)], fill=(139, 69, 19))
     
-    landscape.save(examples_dir / "sample1.jpg", quality=95)
-    print("✅ Created sample1.jpg (Landscape)")
-    
-    # Sample 2: Portrait
+    landscape.save(path, **JPEG_OPTIONS)
+    print(f"✅ Created {path.name} (Landscape)")
+
+def _build_portrait(path: Path):
+    """Sample 2: simple portrait."""
     print("Creating sample portrait image...")
     portrait = Image.new('RGB', (384, 512), (240, 240, 240))  # Light gray
     draw = ImageDraw.Draw(portrait)
@@ -63,10 +61,11 @@ def create_sample_images():
     # Draw body
     draw.rectangle([(160, 200), (224, 400)], fill=(70, 130, 180))  # Blue shirt
     
-    portrait.save(examples_dir / "sample2.jpg", quality=95)
-    print("✅ Created sample2.jpg (Portrait)")
-    
-    # Sample 3: Abstract art
+    portrait.save(path, **JPEG_OPTIONS)
+    print(f"✅ Created {path.name} (Portrait)")
+
+def _build_abstract(path: Path):
+    """Sample 3: abstract art from coloured shapes and lines."""
     print("Creating sample abstract art image...")
     abstract = Image.new('RGB', (512, 512), (255, 255, 255))  # White
     draw = ImageDraw.Draw(abstract)
@@ -97,12 +96,23 @@ def create_sample_images():
         color = colors[i % len(colors)]
         draw.line([(x1, y1), (x2, y2)], fill=color, width=3)
     
-    abstract.save(examples_dir / "sample3.jpg", quality=95)
-    print("✅ Created sample3.jpg (Abstract Art)")
-    
+    abstract.save(path, **JPEG_OPTIONS)
+    print(f"✅ Created {path.name} (Abstract Art)")
+
+def create_sample_images():
+    """Create sample images for the demo examples."""
+
+    # Create examples directory
+    examples_dir = Path("examples")
+    examples_dir.mkdir(exist_ok=True)
+
+    _build_landscape(examples_dir / "sample1.jpg")
+    _build_portrait(examples_dir / "sample2.jpg")
+    _build_abstract(examples_dir / "sample3.jpg")
+
     print("\n🎉 All sample images created successfully!")
     print("📁 Images saved in the 'examples' directory")
     print("🎨 Ready for demo and testing!")
 
 if __name__ == "__main__":
-    create_sample_images() 
\ No newline at end of file
+    create_sample_images()
\ No newline at end of file
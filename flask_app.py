@@ -4,58 +4,289 @@ Flask Web Interface for Image-to-Image Generation Project
 Developed by Tarun Agarwal for Prodigy InfoTech
 """
 
+import gc
 import os
+import re
 import sys
 import logging
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from datetime import datetime
+import gzip
 import json
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 # Add project root to path
 sys.path.append(str(Path(__file__).parent))
 
-from flask import Flask, request, render_template, jsonify, send_file, redirect, url_for
+from flask import Flask, Request, Response, request, jsonify, send_file, send_from_directory, redirect, url_for
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
+import brotli
 from PIL import Image
-import io
-import base64
 
-from config.settings import MODEL_CONFIGS, WEB_SETTINGS, SUPPORTED_FORMATS, ERROR_MESSAGES
-from models.image_generator import ImageGenerator
-from utils.image_utils import validate_image, load_image, save_image, generate_output_filename
+from config.settings import MODEL_CONFIGS, WEB_SETTINGS, SUPPORTED_FORMATS, ERROR_MESSAGES, DEMO_EXAMPLES
+# The generator pulls in torch/diffusers, so it is only imported once a
+# request actually needs a model (see get_generator)
+if TYPE_CHECKING:
+    from models.image_generator import ImageGenerator
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Uploads up to this size are parsed in memory instead of spilling to disk
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
+class SpooledRequest(Request):
+    """Request that keeps typical image uploads in RAM while parsing the form."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode="rb+")
+
 app = Flask(__name__)
+app.request_class = SpooledRequest
 app.config['MAX_CONTENT_LENGTH'] = WEB_SETTINGS['flask']['max_file_size']
 app.config['SECRET_KEY'] = 'prodigy_infotech_image_generation_2024'
 
-# Global generator instance
-generator = None
+# Generations run one at a time on a background worker so request threads
+# return straight away. Job state and finished previews live in JOBS_DIR and
+# are dropped once collected or JOB_TTL after their last update. Each process
+# holds its own models and worker, so serve the app from a single process
+JOB_TTL = 15 * 60
+JOBS_DIR = Path(os.environ.get('FLASK_JOBS_DIR', Path(tempfile.gettempdir()) / 'prodigy_flask_jobs'))
+_JOB_ID = re.compile(r'[0-9a-f]{32}')
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generate')
+
+# Config-only API payloads never change, so serialise them once
+_MODELS_JSON = json.dumps({'success': True, 'models': MODEL_CONFIGS}, separators=(',', ':')).encode()
+_DEMO_JSON = json.dumps({'success': True, 'examples': DEMO_EXAMPLES}, separators=(',', ':')).encode()
+
+# Accepted upload extensions, lowercased and without the leading dot
+_ALLOWED_EXTS = frozenset(fmt.lower().lstrip('.') for fmt in SUPPORTED_FORMATS)
+
+# Generated files are served from here and cached by clients for a year
+RESULTS_DIR = Path("results").resolve()
+RESULT_MAX_AGE = 365 * 24 * 60 * 60
+
+# Loaded generators keyed by model name, least recently used first
+MAX_CACHED_MODELS = 2
+_generators: "OrderedDict[str, ImageGenerator]" = OrderedDict()
+_gen_lock = threading.Lock()
+
+# DeepCache feature reuse: recompute the deep U-Net branch every N steps
+DEEPCACHE_INTERVAL = 3
+DEEPCACHE_BRANCH_ID = 0
+# DeepCache patches the shared pipe in place, so generations hold this
+# while it is wrapped, even if more generation workers are added later
+_pipe_lock = threading.Lock()
+
+def _release_generator(generator: "ImageGenerator"):
+    """Drop an evicted generator's pipeline so its weights can be freed."""
+    generator.pipe = None
+
+def _free_released_memory():
+    """Collect dropped pipelines and return their cached VRAM before the next model loads."""
+    gc.collect()
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+@contextmanager
+def deepcache(generator: "ImageGenerator", enabled: bool = True):
+    """
+    Reuse deep U-Net features across adjacent denoising steps while active.
+    
+    Yields whether caching is on: if DeepCache is missing or can't wrap this
+    pipeline, the block runs uncached and a warning is logged.
+    """
+    helper = None
+    if enabled:
+        try:
+            from DeepCache import DeepCacheSDHelper
+            helper = DeepCacheSDHelper(pipe=generator.pipe)
+            helper.set_params(cache_interval=DEEPCACHE_INTERVAL, cache_branch_id=DEEPCACHE_BRANCH_ID)
+            helper.enable()
+        except Exception as e:
+            logger.warning(f"DeepCache unavailable, running uncached: {str(e)}")
+            if helper is not None:
+                helper.disable()
+            helper = None
+    try:
+        yield helper is not None
+    finally:
+        if helper is not None:
+            helper.disable()
+
+def get_generator(model_name: str = "stable-diffusion") -> "ImageGenerator":
+    """Get a cached generator instance, loading it on first use."""
+    with _gen_lock:
+        generator = _generators.get(model_name)
+        if generator is not None:
+            _generators.move_to_end(model_name)
+            return generator
+
+        if len(_generators) >= MAX_CACHED_MODELS:
+            while len(_generators) >= MAX_CACHED_MODELS:
+                evicted_name, evicted = _generators.popitem(last=False)
+                logger.info(f"Evicting generator for {evicted_name}")
+                _release_generator(evicted)
+                del evicted
+            _free_released_memory()
 
-def get_generator(model_name: str = "stable-diffusion") -> ImageGenerator:
-    """Get or create generator instance."""
-    global generator
-    if generator is None or generator.model_name != model_name:
         try:
+            from models.image_generator import ImageGenerator
             generator = ImageGenerator(model_name=model_name)
         except Exception as e:
             logger.error(f"Error initializing generator: {str(e)}")
             raise
-    return generator
+        _generators[model_name] = generator
+        return generator
+
+@dataclass
+class GenParams:
+    """Parameters for /api/generate, parsed once from the submitted form."""
+    prompt: str
+    model: str = 'stable-diffusion'
+    strength: float = 0.75
+    guidance_scale: float = 7.5
+    num_steps: int = 50
+    use_deepcache: bool = True
+
+    @classmethod
+    def from_form(cls, form) -> "GenParams":
+        """Build parameters from form fields, filling gaps from the model defaults.
+
+        Raises:
+            ValueError: If a field is missing or cannot be parsed.
+        """
+        prompt = form.get('prompt', '').strip()
+        if not prompt:
+            raise ValueError('Prompt is required')
+
+        model = form.get('model', 'stable-diffusion')
+        config = MODEL_CONFIGS.get(model)
+        if config is None:
+            raise ValueError(ERROR_MESSAGES['model_not_found'])
+
+        try:
+            strength = float(form.get('strength', config['default_strength']))
+            guidance_scale = float(form.get('guidance_scale', config['default_guidance_scale']))
+            num_steps = int(form.get('num_steps', 50))
+        except ValueError:
+            raise ValueError('Invalid generation parameters') from None
+
+        return cls(
+            prompt=prompt,
+            model=model,
+            strength=strength,
+            guidance_scale=guidance_scale,
+            num_steps=num_steps,
+            # Single-step (Turbo style) runs have no adjacent steps to share features
+            use_deepcache=form.get('use_deepcache', 'true').lower() == 'true' and num_steps > 1
+        )
+
+def run_generation(params: GenParams, input_image: Image.Image) -> dict:
+    """Run one queued generation on the background worker."""
+    generator = get_generator(params.model)
+    if params.use_deepcache:
+        try:
+            with _pipe_lock, deepcache(generator) as cached:
+                result = _generate(generator, params, input_image)
+            if not cached or result['success']:
+                return result
+            error = result['error']
+        except Exception as e:
+            error = str(e)
+        logger.warning(f"Generation with DeepCache failed, retrying uncached: {error}")
+    with _pipe_lock:
+        return _generate(generator, params, input_image)
+
+def _generate(generator: "ImageGenerator", params: GenParams, input_image: Image.Image) -> dict:
+    """Call generate() with the job's parameters."""
+    return generator.generate(
+        input_image=input_image,
+        prompt=params.prompt,
+        strength=params.strength,
+        guidance_scale=params.guidance_scale,
+        num_inference_steps=params.num_steps
+    )
+
+def _write_job(job_id: str, **record):
+    """Atomically replace a job's state record."""
+    path = JOBS_DIR / f'{job_id}.json'
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(record, default=str))
+    os.replace(tmp, path)
+
+def _read_job(job_id: str) -> Optional[dict]:
+    """A job's state record, or None if it is unknown, collected or expired."""
+    try:
+        return json.loads((JOBS_DIR / f'{job_id}.json').read_text())
+    except FileNotFoundError:
+        return None
+
+def _forget_job(job_id: str):
+    """Delete a collected job's files."""
+    for suffix in ('.json', '.jpg'):
+        (JOBS_DIR / f'{job_id}{suffix}').unlink(missing_ok=True)
+
+def _prune_jobs():
+    """Remove job files nobody collected within JOB_TTL."""
+    cutoff = time.time() - JOB_TTL
+    for path in JOBS_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+def run_job(job_id: str, params: GenParams, input_image: Image.Image, filename: str):
+    """Background worker body: generate, then publish the preview and metadata for pollers."""
+    # Anything raised here would vanish into the executor's future and leave
+    # the job polling as running until JOB_TTL, so every failure is recorded
+    try:
+        _write_job(job_id, state='running')
+        result = run_generation(params, input_image)
+        if not result['success']:
+            _write_job(job_id, state='error', error=result['error'])
+            return
+
+        # Publish a JPEG preview; the lossless PNG stays at output_path
+        result['generated_image'].save(JOBS_DIR / f'{job_id}.jpg', format='JPEG', quality=90,
+                                       optimize=False, progressive=False)
+        _write_job(job_id, state='done', metadata=result['metadata'],
+                   output_path=str(result['output_path']), filename=filename)
+    except Exception as e:
+        logger.error(f"Error during generation: {str(e)}")
+        _write_job(job_id, state='error', error=ERROR_MESSAGES['processing_error'])
+
+def open_upload(stream) -> Image.Image:
+    """Check an uploaded image from its headers, then decode it exactly once."""
+    with Image.open(stream) as probe:
+        probe.verify()
+    stream.seek(0)
+    return Image.open(stream).convert("RGB")
 
 @app.route('/')
 def index():
     """Main page."""
-    return render_template('index.html', models=MODEL_CONFIGS)
+    return html_page('index.html')
 
 @app.route('/api/generate', methods=['POST'])
 def generate_image():
     """API endpoint for image generation."""
     try:
+        # Reject oversized bodies before the multipart parser reads them
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'success': False, 'error': ERROR_MESSAGES['file_too_large']}), 413
+
         # Get form data
         if 'image' not in request.files:
             return jsonify({'success': False, 'error': 'No image file provided'}), 400
@@ -65,87 +296,69 @@ def generate_image():
             return jsonify({'success': False, 'error': 'No image file selected'}), 400
             
         # Validate file
-        if not file.filename.lower().endswith(tuple(SUPPORTED_FORMATS)):
+        _, dot, ext = file.filename.rpartition('.')
+        if not dot or ext.lower() not in _ALLOWED_EXTS:
             return jsonify({'success': False, 'error': ERROR_MESSAGES['invalid_image']}), 400
             
         # Get parameters
-        prompt = request.form.get('prompt', '').strip()
-        if not prompt:
-            return jsonify({'success': False, 'error': 'Prompt is required'}), 400
-            
-        model_name = request.form.get('model', 'stable-diffusion')
-        if model_name not in MODEL_CONFIGS:
-            return jsonify({'success': False, 'error': ERROR_MESSAGES['model_not_found']}), 400
-            
-        strength = float(request.form.get('strength', MODEL_CONFIGS[model_name]['default_strength']))
-        guidance_scale = float(request.form.get('guidance_scale', MODEL_CONFIGS[model_name]['default_guidance_scale']))
-        num_steps = int(request.form.get('num_steps', 50))
-        
-        # Save uploaded file temporarily
+        try:
+            params = GenParams.from_form(request.form)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_filename = f"upload_{timestamp}_{filename}"
-        temp_path = Path("results") / temp_filename
-        
-        temp_path.parent.mkdir(exist_ok=True)
-        file.save(str(temp_path))
-        
+
+        # Decode the upload straight from the request stream
         try:
-            # Validate the uploaded image
-            if not validate_image(temp_path):
-                return jsonify({'success': False, 'error': 'Invalid image file'}), 400
-                
-            # Initialize generator
-            generator = get_generator(model_name)
-            
-            # Generate image
-            result = generator.generate(
-                input_image=str(temp_path),
-                prompt=prompt,
-                strength=strength,
-                guidance_scale=guidance_scale,
-                num_inference_steps=num_steps
-            )
-            
-            if result['success']:
-                # Convert generated image to base64 for display
-                img_buffer = io.BytesIO()
-                result['generated_image'].save(img_buffer, format='PNG')
-                img_str = base64.b64encode(img_buffer.getvalue()).decode()
-                
-                response_data = {
-                    'success': True,
-                    'image_data': f"data:image/png;base64,{img_str}",
-                    'output_path': result['output_path'],
-                    'metadata': result['metadata']
-                }
-                
-                # Clean up temp file
-                temp_path.unlink(missing_ok=True)
-                
-                return jsonify(response_data)
-            else:
-                return jsonify({'success': False, 'error': result['error']}), 500
-                
-        except Exception as e:
-            logger.error(f"Error during generation: {str(e)}")
-            return jsonify({'success': False, 'error': ERROR_MESSAGES['processing_error']}), 500
-            
-        finally:
-            # Clean up temp file
-            temp_path.unlink(missing_ok=True)
-            
+            input_image = open_upload(file.stream)
+        except Exception:
+            return jsonify({'success': False, 'error': 'Invalid image file'}), 400
+
+        # Queue the generation and hand back a job id to poll
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        _prune_jobs()
+        job_id = uuid.uuid4().hex
+        _write_job(job_id, state='queued')
+        _executor.submit(run_job, job_id, params, input_image, filename)
+
+        return jsonify({'success': True, 'job_id': job_id}), 202
+
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """Poll a generation job; answers with the preview image once it is done."""
+    job = _read_job(job_id) if _JOB_ID.fullmatch(job_id) else None
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    if job['state'] in ('queued', 'running'):
+        return jsonify({'success': True, 'state': job['state']})
+
+    if job['state'] == 'error':
+        _forget_job(job_id)
+        return jsonify({'success': False, 'error': job['error']}), 500
+
+    # Send the JPEG preview as the response body; metadata goes in headers.
+    # The open handle keeps the file readable after the job is forgotten
+    try:
+        preview = open(JOBS_DIR / f'{job_id}.jpg', 'rb')
+    except FileNotFoundError:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    _forget_job(job_id)
+
+    response = send_file(preview, mimetype='image/jpeg', conditional=False)
+    response.headers['X-Metadata'] = json.dumps(job['metadata'])
+    response.headers['X-Output-Path'] = job['output_path']
+    response.headers['X-Input-Filename'] = job['filename']
+    return response
+
 @app.route('/api/models')
 def get_models():
     """Get available models."""
-    return jsonify({
-        'success': True,
-        'models': MODEL_CONFIGS
-    })
+    return Response(_MODELS_JSON, mimetype='application/json')
 
 @app.route('/api/status')
 def get_status():
@@ -170,25 +383,30 @@ def get_status():
 @app.route('/results/<filename>')
 def download_result(filename):
     """Download generated result."""
-    result_path = Path("results") / filename
-    if result_path.exists():
-        return send_file(str(result_path), as_attachment=True)
-    else:
+    # Result files are never rewritten, so clients may cache them for good;
+    # conditional=True answers If-None-Match/If-Modified-Since and Range requests
+    try:
+        response = send_from_directory(
+            RESULTS_DIR, filename,
+            as_attachment=True,
+            conditional=True,
+            max_age=RESULT_MAX_AGE
+        )
+    except NotFound:
         return jsonify({'success': False, 'error': 'File not found'}), 404
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/demo')
 def demo():
     """Demo page with examples."""
-    return render_template('demo.html', models=MODEL_CONFIGS)
+    return html_page('demo.html')
 
 @app.route('/api/demo-examples')
 def get_demo_examples():
     """Get demo examples."""
-    from config.settings import DEMO_EXAMPLES
-    return jsonify({
-        'success': True,
-        'examples': DEMO_EXAMPLES
-    })
+    return Response(_DEMO_JSON, mimetype='application/json')
 
 @app.errorhandler(413)
 def too_large(e):
@@ -205,13 +423,8 @@ def internal_error(e):
     """Handle internal server errors."""
     return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
-if __name__ == '__main__':
-    # Create templates directory and HTML files
-    templates_dir = Path("templates")
-    templates_dir.mkdir(exist_ok=True)
-    
-    # Create index.html template
-    index_html = '''<!DOCTYPE html>
+# Static pages, compressed once at import instead of rendered per request
+INDEX_HTML = '''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -514,6 +727,22 @@ if __name__ == '__main__':
             document.getElementById('stepsValue').textContent = e.target.value;
         });
         
+        // Poll a generation job until its image is ready
+        async function waitForJob(jobId) {
+            while (true) {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                const contentType = response.headers.get('Content-Type') || '';
+                if (response.ok && contentType.startsWith('image/')) {
+                    return response;
+                }
+                const status = await response.json();
+                if (!status.success) {
+                    throw new Error(status.error);
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+        
         // Form submission
         document.getElementById('generationForm').addEventListener('submit', async (e) => {
             e.preventDefault();
@@ -550,18 +779,26 @@ if __name__ == '__main__':
                     body: formData
                 });
                 
-                const result = await response.json();
+                const submitted = await response.json();
                 
-                if (result.success) {
-                    document.getElementById('resultImage').src = result.image_data;
+                if (submitted.success) {
+                    // The image comes back as raw bytes, metadata rides in headers
+                    const jobResponse = await waitForJob(submitted.job_id);
+                    const blob = await jobResponse.blob();
+                    const metadata = JSON.parse(jobResponse.headers.get('X-Metadata'));
+                    const resultImage = document.getElementById('resultImage');
+                    if (resultImage.src.startsWith('blob:')) {
+                        URL.revokeObjectURL(resultImage.src);
+                    }
+                    resultImage.src = URL.createObjectURL(blob);
                     document.getElementById('resultInfo').innerHTML = `
-                        <p><strong>Generation Time:</strong> ${result.metadata.generation_time.toFixed(2)}s</p>
-                        <p><strong>Model:</strong> ${result.metadata.model}</p>
-                        <p><strong>Parameters:</strong> Strength: ${result.metadata.strength}, Guidance: ${result.metadata.guidance_scale}, Steps: ${result.metadata.num_inference_steps}</p>
+                        <p><strong>Generation Time:</strong> ${metadata.generation_time.toFixed(2)}s</p>
+                        <p><strong>Model:</strong> ${metadata.model}</p>
+                        <p><strong>Parameters:</strong> Strength: ${metadata.strength}, Guidance: ${metadata.guidance_scale}, Steps: ${metadata.num_inference_steps}</p>
                     `;
                     document.getElementById('resultSection').style.display = 'block';
                 } else {
-                    alert('Error: ' + result.error);
+                    alert('Error: ' + submitted.error);
                 }
             } catch (error) {
                 alert('Error: ' + error.message);
@@ -573,12 +810,8 @@ if __name__ == '__main__':
     </script>
 </body>
 </html>'''
-    
-    with open(templates_dir / "index.html", "w", encoding="utf-8") as f:
-        f.write(index_html)
-    
-    # Create demo.html template
-    demo_html = '''<!DOCTYPE html>
+
+DEMO_HTML = '''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -688,10 +921,33 @@ if __name__ == '__main__':
     </script>
 </body>
 </html>'''
-    
-    with open(templates_dir / "demo.html", "w", encoding="utf-8") as f:
-        f.write(demo_html)
-    
+
+def _precompress(html: str) -> dict:
+    """Encode a page once per supported Content-Encoding."""
+    raw = html.encode('utf-8')
+    return {
+        'br': brotli.compress(raw, quality=11),
+        'gzip': gzip.compress(raw, compresslevel=9),
+        'identity': raw
+    }
+
+_PAGES = {
+    'index.html': _precompress(INDEX_HTML),
+    'demo.html': _precompress(DEMO_HTML)
+}
+
+def html_page(name: str) -> Response:
+    """Serve a static page in the best encoding the client accepts."""
+    bodies = _PAGES[name]
+    # best_match weighs q-values, so "br;q=0" rules brotli out; ties prefer br
+    encoding = request.accept_encodings.best_match(('br', 'gzip'), default='identity')
+    response = Response(bodies[encoding], mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+if __name__ == '__main__':
     print("🚀 Starting Flask Web Interface...")
     print("📱 Access the application at: http://localhost:5000")
     print("🎨 Developed by Tarun Agarwal for Prodigy InfoTech")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Shared generator cache for the CLI and web interfaces
+Developed by Tarun Agarwal for Prodigy InfoTech
+"""
+
+import functools
+
+# Loaded pipelines kept alive at once; least recently used models are dropped
+MAX_CACHED_GENERATORS = 4
+
+# UNet weight quantization modes; "none" keeps the pipeline's own dtype
+QUANTIZE_MODES = ("none", "int8", "fp8")
+
+def get_generator(model_name: str = "stable-diffusion", quantize: str = "none"):
+    """Return the loaded ImageGenerator for a model, loading its weights on first use."""
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantize}")
+    # lru_cache keys on arguments exactly as passed, so always call it the same way
+    return _load(model_name, quantize)
+
+@functools.lru_cache(maxsize=MAX_CACHED_GENERATORS)
+def _load(model_name: str, quantize: str):
+    """Load a model's pipeline, quantizing its UNet unless quantize is "none"."""
+    from models.image_generator import ImageGenerator
+    generator = ImageGenerator(model_name=model_name)
+    if quantize != "none":
+        quantize_unet(generator, quantize)
+    return generator
+
+def quantize_unet(generator, mode: str):
+    """Quantize the UNet weights in place with optimum-quanto."""
+    try:
+        from optimum.quanto import freeze, qfloat8, qint8, quantize
+    except ImportError as e:
+        raise ImportError("Quantization requires optimum-quanto: pip install optimum-quanto") from e
+    unet = generator.pipe.unet
+    quantize(unet, weights=qint8 if mode == "int8" else qfloat8)
+    freeze(unet)
\ No newline at end of file
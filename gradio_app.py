@@ -6,49 +6,260 @@ Developed by Tarun Agarwal for Prodigy InfoTech
 
 import os
 import sys
+import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime
+from typing import TYPE_CHECKING
 import gradio as gr
 from PIL import Image
-import numpy as np
 
 # Add project root to path
 sys.path.append(str(Path(__file__).parent))
 
+# Persist Inductor's compiled kernels on disk (before torch is imported) so
+# restarts and sibling workers load them instead of recompiling
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(Path(__file__).parent / ".inductor_cache"))
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+os.environ.setdefault("TRANSFORMERS_VERBOSITY", "error")
+
 from config.settings import MODEL_CONFIGS, WEB_SETTINGS, DEMO_EXAMPLES
-from models.image_generator import ImageGenerator
-from utils.image_utils import validate_image, load_image, save_image, generate_output_filename
+from generator_cache import get_generator as load_generator
+from batch_pipeline import generate_batch, reserve_output_path, save_result
+from utils.image_utils import load_image
+
+if TYPE_CHECKING:
+    from models.image_generator import ImageGenerator
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global generator instance
-generator = None
+def default_quantization() -> str:
+    """WEB_SETTINGS['gradio']['quantize'] if set, else INT8 on GPUs with INT8 tensor cores (sm_80+)."""
+    if "quantize" in WEB_SETTINGS['gradio']:
+        return WEB_SETTINGS['gradio']['quantize']
+    import torch
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 0):
+        return "none"
+    try:
+        import optimum.quanto  # noqa: F401
+    except ImportError:
+        return "none"
+    return "int8"
 
-def get_generator(model_name: str = "stable-diffusion") -> ImageGenerator:
+def get_generator(model_name: str = "stable-diffusion") -> "ImageGenerator":
     """Get or create generator instance."""
-    global generator
-    if generator is None or generator.model_name != model_name:
+    try:
+        generator = load_generator(model_name, default_quantization())
+    except Exception as e:
+        logger.error(f"Error initializing generator: {str(e)}")
+        raise
+    compile_generator(generator)
+    return generator
+
+def compile_generator(generator: "ImageGenerator"):
+    """Compile the UNet and run a warmup pass so the first request skips compilation."""
+    import torch
+    if not torch.cuda.is_available():
+        return
+    # One attempt per generator: it comes back from the shared cache on every
+    # request, and a failed compile restores the plain UNet
+    if getattr(generator, "_compile_attempted", False):
+        return
+    generator._compile_attempted = True
+    pipe = generator.pipe
+    unet = pipe.unet
+    try:
+        pipe.unet = torch.compile(unet, mode="reduce-overhead")
+        warmup_image = Image.new("RGB", (512, 512))
+        with torch.inference_mode():
+            pipe(prompt="", image=warmup_image, strength=1.0, num_inference_steps=2)
+    except Exception as e:
+        pipe.unet = unet
+        logger.warning(f"torch.compile warmup failed, continuing uncompiled: {str(e)}")
+
+MAX_CONCURRENCY = 4
+
+def default_concurrency() -> int:
+    """
+    How many generations may share the GPU; GRADIO_CONCURRENCY overrides the estimate.
+    
+    The default model is loaded first so its weights are already resident,
+    then one warm generation measures what each request adds on top of them.
+    """
+    if "GRADIO_CONCURRENCY" in os.environ:
+        return max(1, int(os.environ["GRADIO_CONCURRENCY"]))
+    import torch
+    if not torch.cuda.is_available():
+        return 1
+    try:
+        per_request = measure_request_vram(get_generator())
+    except Exception as e:
+        logger.warning(f"Could not measure per-request VRAM, serving one at a time: {str(e)}")
+        return 1
+    free_bytes, _ = torch.cuda.mem_get_info()
+    # Blocks PyTorch has cached but not handed out are free for requests too
+    free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    return max(1, min(MAX_CONCURRENCY, free_bytes // per_request))
+
+def measure_request_vram(generator: "ImageGenerator") -> int:
+    """Peak VRAM one 512x512 generation allocates beyond the loaded weights."""
+    import torch
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    baseline = torch.cuda.memory_allocated()
+    with torch.inference_mode():
+        generator.pipe(prompt="", image=Image.new("RGB", (512, 512)), strength=1.0, num_inference_steps=2)
+    torch.cuda.synchronize()
+    return max(1, torch.cuda.max_memory_allocated() - baseline)
+
+class BatchedGenerator:
+    """
+    Packs concurrent Gradio requests into batched pipeline calls.
+    
+    Requests only share a batch when model and sampling settings match. The
+    first request of a batch waits at most max_latency seconds for company.
+    """
+    
+    def __init__(self, max_batch_size: int = 4, max_latency: float = 0.05):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = None
+        self._worker = None
+        # Requests pulled off the queue that did not fit the batch being built
+        self._deferred = []
+        
+    async def submit(self, input_image, prompt, model_name, strength, guidance_scale, num_steps,
+                     save_output: bool = False) -> dict:
+        """Queue one request and wait for its generator result."""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        key = (model_name, strength, guidance_scale, num_steps, save_output)
+        await self._queue.put((key, input_image, prompt, future))
+        return await future
+        
+    async def _next_job(self):
+        if self._deferred:
+            return self._deferred.pop(0)
+        return await self._queue.get()
+        
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._next_job()
+            batch = [first]
+            
+            # Deferred jobs with matching settings join straight away
+            for job in list(self._deferred):
+                if len(batch) >= self.max_batch_size:
+                    break
+                if job[0] == first[0]:
+                    batch.append(job)
+                    self._deferred.remove(job)
+                    
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if job[0] == first[0]:
+                    batch.append(job)
+                else:
+                    self._deferred.append(job)
+                    
+            await self._dispatch(batch)
+            
+    async def _dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        model_name, strength, guidance_scale, num_steps, save_output = batch[0][0]
+        images = [job[1] for job in batch]
+        prompts = [job[2] for job in batch]
         try:
-            generator = ImageGenerator(model_name=model_name)
+            results = await loop.run_in_executor(
+                None, self._generate, model_name, images, prompts,
+                strength, guidance_scale, num_steps, save_output
+            )
         except Exception as e:
-            logger.error(f"Error initializing generator: {str(e)}")
-            raise
-    return generator
+            for job in batch:
+                if not job[3].done():
+                    job[3].set_exception(e)
+            return
+        for job, result in zip(batch, results):
+            if not job[3].done():
+                job[3].set_result(result)
+                
+    @staticmethod
+    def _generate(model_name, images, prompts, strength, guidance_scale, num_steps, save_output):
+        generator = get_generator(model_name)
+        # One pipeline call for the whole batch; its outputs come back unsaved
+        results = generate_batch(generator, images, prompts, strength, guidance_scale, num_steps)
+        if save_output:
+            for result in results:
+                if result['success']:
+                    try:
+                        output_path = reserve_output_path("upload", model_name, result['metadata']['prompt'])
+                        save_result(result['generated_image'], output_path, result['metadata'])
+                        result['output_path'] = str(output_path)
+                    except Exception as e:
+                        logger.warning(f"Could not save generated image: {str(e)}")
+        return results
+
+batcher = BatchedGenerator()
+
+# Success summary shown next to the generated image, filled from result metadata
+METADATA_TMPL = """
+✅ Generation Successful!
+
+📊 Generation Details:
+• Model: {model}
+• Generation Time: {generation_time:.2f}s
+• Strength: {strength}
+• Guidance Scale: {guidance_scale}
+• Steps: {num_inference_steps}
+• Device: {device}
+• Input Size: {input_size}
+• Output Size: {output_size}
 
-def generate_image_gradio(input_image, prompt, model_name, strength, guidance_scale, num_steps):
+💾 Saved to: {output_path}
+""".format_map
+NOT_SAVED = '— (tick "Save to disk" to keep a copy)'
+
+# Recent (image, prompt, settings) -> (generated image, metadata text)
+RESULT_CACHE_SIZE = 128
+_result_cache = OrderedDict()
+
+def result_cache_key(input_image, prompt, model_name, strength, guidance_scale, num_steps,
+                     save_output) -> bytes:
+    """Digest of the input pixels plus every parameter that affects the output."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(input_image.tobytes())
+    digest.update(repr((input_image.mode, input_image.size, prompt, model_name,
+                        strength, guidance_scale, num_steps, save_output)).encode())
+    return digest.digest()
+
+async def generate_image_gradio(input_image, prompt, model_name, strength, guidance_scale, num_steps,
+                                save_output=False):
     """
     Generate image using Gradio interface.
     
     Args:
-        input_image: Input image (PIL Image or numpy array)
+        input_image: Input PIL Image
         prompt: Text prompt for generation
         model_name: Model to use
         strength: Denoising strength
         guidance_scale: Guidance scale
         num_steps: Number of inference steps
+        save_output: Also write the result to the results directory
         
     Returns:
         tuple: (generated_image, metadata_text)
@@ -57,45 +268,41 @@ def generate_image_gradio(input_image, prompt, model_name, strength, guidance_sc
         if input_image is None:
             return None, "❌ Please upload an input image."
             
-        if not prompt or not prompt.strip():
+        # gr.Image(type="pil") already hands over a PIL image
+        prompt = (prompt or "").strip()
+        if not prompt:
             return None, "❌ Please enter a prompt."
             
-        # Convert numpy array to PIL Image if needed
-        if isinstance(input_image, np.ndarray):
-            input_image = Image.fromarray(input_image)
+        # Identical image + settings were generated recently
+        cache_key = result_cache_key(input_image, prompt, model_name, strength, guidance_scale, num_steps,
+                                     save_output)
+        cached = _result_cache.get(cache_key)
+        if cached is not None:
+            _result_cache.move_to_end(cache_key)
+            return cached
             
-        # Initialize generator
-        generator = get_generator(model_name)
-        
-        # Generate image
-        result = generator.generate(
+        # Generate image, sharing a pipeline call with any concurrent
+        # requests that use the same settings
+        result = await batcher.submit(
             input_image=input_image,
             prompt=prompt,
+            model_name=model_name,
             strength=strength,
             guidance_scale=guidance_scale,
-            num_inference_steps=num_steps
+            num_steps=num_steps,
+            save_output=save_output
         )
         
         if result['success']:
             # Create metadata text
-            metadata = result['metadata']
-            metadata_text = f"""
-✅ Generation Successful!
-
-📊 Generation Details:
-• Model: {metadata['model']}
-• Generation Time: {metadata['generation_time']:.2f}s
-• Strength: {metadata['strength']}
-• Guidance Scale: {metadata['guidance_scale']}
-• Steps: {metadata['num_inference_steps']}
-• Device: {metadata['device']}
-• Input Size: {metadata['input_size']}
-• Output Size: {metadata['output_size']}
-
-💾 Saved to: {result['output_path']}
-            """
+            metadata_text = METADATA_TMPL({**result['metadata'],
+                                           'output_path': result.get('output_path') or NOT_SAVED})
             
-            return result['generated_image'], metadata_text
+            output = (result['generated_image'], metadata_text)
+            _result_cache[cache_key] = output
+            if len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+            return output
         else:
             return None, f"❌ Generation failed: {result['error']}"
             
@@ -103,7 +310,7 @@ def generate_image_gradio(input_image, prompt, model_name, strength, guidance_sc
         logger.error(f"Error in Gradio generation: {str(e)}")
         return None, f"❌ Error: {str(e)}"
 
-def run_demo_example(example_index):
+async def run_demo_example(example_index):
     """Run a demo example."""
     try:
         if example_index >= len(DEMO_EXAMPLES):
@@ -119,7 +326,7 @@ def run_demo_example(example_index):
         input_image = load_image(example['input'])
         
         # Generate using the example parameters
-        result = generate_image_gradio(
+        result = await generate_image_gradio(
             input_image=input_image,
             prompt=example['prompt'],
             model_name=example['model'],
@@ -134,11 +341,18 @@ def run_demo_example(example_index):
         logger.error(f"Error running demo example: {str(e)}")
         return None, f"❌ Error running demo: {str(e)}"
 
-def get_model_info(model_name):
-    """Get information about the selected model."""
-    if model_name in MODEL_CONFIGS:
-        config = MODEL_CONFIGS[model_name]
-        return f"""
+async def run_demo_selection(label):
+    """Run the demo example picked in the dropdown ("<n>. <name>")."""
+    return await run_demo_example(int(label.split('.')[0]) - 1)
+
+async def prewarm_demo_examples():
+    """Generate every demo example once so the results cache is populated."""
+    for index in range(len(DEMO_EXAMPLES)):
+        await run_demo_example(index)
+
+def _format_model_info(model_name, config):
+    """Model information text shown under the model dropdown."""
+    return f"""
 📋 Model Information:
 • Name: {model_name}
 • Description: {config['description']}
@@ -146,8 +360,14 @@ def get_model_info(model_name):
 • Default Strength: {config['default_strength']}
 • Default Guidance Scale: {config['default_guidance_scale']}
         """
-    else:
-        return "❌ Model not found."
+
+# The settings are static, so the dropdown texts are built once at import
+_MODEL_INFO = {name: _format_model_info(name, config) for name, config in MODEL_CONFIGS.items()}
+_DEMO_LABELS = tuple(f"{i+1}. {ex['name']}" for i, ex in enumerate(DEMO_EXAMPLES))
+
+def get_model_info(model_name):
+    """Get information about the selected model."""
+    return _MODEL_INFO.get(model_name, "❌ Model not found.")
 
 def create_gradio_interface():
     """Create the Gradio interface."""
@@ -245,6 +465,12 @@ def create_gradio_interface():
                             info="Number of inference steps"
                         )
                         
+                        save_output = gr.Checkbox(
+                            value=False,
+                            label="Save to disk",
+                            info="Also write the result to the results folder"
+                        )
+                        
                         generate_btn = gr.Button(
                             "🎨 Generate Image",
                             variant="primary",
@@ -276,8 +502,9 @@ def create_gradio_interface():
                 # Connect components
                 generate_btn.click(
                     fn=generate_image_gradio,
-                    inputs=[input_image, prompt, model_name, strength, guidance_scale, num_steps],
-                    outputs=[output_image, output_info]
+                    inputs=[input_image, prompt, model_name, strength, guidance_scale, num_steps, save_output],
+                    outputs=[output_image, output_info],
+                    concurrency_id="gpu"
                 )
                 
                 # Update model info when model changes
@@ -294,7 +521,7 @@ def create_gradio_interface():
                 with gr.Row():
                     with gr.Column():
                         demo_examples = gr.Dropdown(
-                            choices=[f"{i+1}. {ex['name']}" for i, ex in enumerate(DEMO_EXAMPLES)],
+                            choices=list(_DEMO_LABELS),
                             label="Select Demo Example",
                             value="1. Landscape to Oil Painting"
                         )
@@ -318,9 +545,10 @@ def create_gradio_interface():
                 
                 # Connect demo components
                 run_demo_btn.click(
-                    fn=lambda x: run_demo_example(int(x.split('.')[0]) - 1),
+                    fn=run_demo_selection,
                     inputs=[demo_examples],
-                    outputs=[demo_output_image, demo_output_info]
+                    outputs=[demo_output_image, demo_output_info],
+                    concurrency_id="gpu"
                 )
             
             # About Tab
@@ -381,6 +609,10 @@ def create_gradio_interface():
         </div>
         """)
     
+    # Both GPU events share the "gpu" concurrency group, so together they
+    # never run more generations than the device has memory for
+    interface.queue(default_concurrency_limit=default_concurrency(), max_size=64)
+    
     return interface
 
 def main():
@@ -389,6 +621,11 @@ def main():
     print("📱 Access the application at: http://localhost:7860")
     print("🎨 Developed by Tarun Agarwal for Prodigy InfoTech")
     
+    # Optionally run the demo examples up front so their first click is a cache hit
+    if os.environ.get("GRADIO_PREWARM_DEMOS") == "1":
+        print("🔥 Pre-warming demo examples...")
+        asyncio.run(prewarm_demo_examples())
+    
     # Create the interface
     interface = create_gradio_interface()
     
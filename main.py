@@ -7,19 +7,28 @@ Using the capabilities of Gen AI for creating a world with technologies.
 """
 
 import argparse
+import gc
 import logging
+import os
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 import json
 
 # Add project root to path
 sys.path.append(str(Path(__file__).parent))
 
+# Keep transformers' load-time warnings out of CLI output
+os.environ.setdefault("TRANSFORMERS_VERBOSITY", "error")
+
 from config.settings import MODEL_CONFIGS, DEMO_EXAMPLES, LOGGING_CONFIG
-from models.image_generator import ImageGenerator
-from utils.image_utils import validate_image, load_image, create_image_grid, cleanup_old_results
-from utils.image_utils import get_image_info
+from generator_cache import QUANTIZE_MODES, get_generator
+
+# torch/diffusers and the image utilities are only imported by the commands
+# that use them, so --list-models, --cleanup and --help start instantly
 
 # Setup logging
 logging.basicConfig(
@@ -56,7 +65,7 @@ def run_demo_examples():
     print("\n🎨 Running Demo Examples...")
     print("=" * 50)
     
-    generator = ImageGenerator(model_name="stable-diffusion")
+    generator = get_generator("stable-diffusion")
     
     for i, example in enumerate(DEMO_EXAMPLES, 1):
         print(f"\n📸 Demo {i}: {example['name']}")
@@ -90,15 +99,17 @@ def run_demo_examples():
 
 def process_single_image(input_path: str, prompt: str, model: str, 
                        strength: float, guidance_scale: float, 
-                       num_steps: int) -> dict:
+                       num_steps: int, quantize: str = "none") -> dict:
     """Process a single image."""
+    from utils.image_utils import validate_image
+    
     try:
         # Validate input image
         if not validate_image(input_path):
             return {"success": False, "error": "Invalid input image"}
             
-        # Initialize generator
-        generator = ImageGenerator(model_name=model)
+        # Reuse the loaded generator for this model
+        generator = get_generator(model, quantize)
         
         # Generate image
         result = generator.generate(
@@ -115,49 +126,173 @@ def process_single_image(input_path: str, prompt: str, model: str,
         logger.error(f"Error processing image: {str(e)}")
         return {"success": False, "error": str(e)}
 
+def prefetch_chunks(image_files: List[Path], batch_size: int, loader: ThreadPoolExecutor,
+                    depth: int = 2) -> Iterator[Tuple[List[Path], list]]:
+    """
+    Yield (files, images) chunks, decoding up to `depth` chunks ahead on `loader`.
+    
+    A file that fails to load appears as the exception it raised, so one bad
+    file doesn't stop the rest of the batch.
+    """
+    from utils.image_utils import load_image
+    
+    pending = deque()
+    for start in range(0, len(image_files), batch_size):
+        chunk = image_files[start:start + batch_size]
+        pending.append((chunk, [loader.submit(load_image, str(f)) for f in chunk]))
+        if len(pending) > depth:
+            files, futures = pending.popleft()
+            yield files, [decoded(future) for future in futures]
+    while pending:
+        files, futures = pending.popleft()
+        yield files, [decoded(future) for future in futures]
+
+def decoded(future: Future):
+    """A prefetched image, or the exception its load raised."""
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+# Single-image success summary, filled from result metadata
+RESULT_TMPL = """✅ Generation successful!
+📁 Output: {output_path}
+⏱️  Time: {generation_time:.2f}s""".format_map
+
+# File extensions picked up by --input-dir, matched case-insensitively
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'})
+
+# Batch results between explicit garbage collections
+GC_INTERVAL = 32
+
+# Background PNG encoders for batch outputs, and how many finished images may
+# wait on them before generation pauses
+OUTPUT_WRITERS = 4
+MAX_PENDING_WRITES = 2 * OUTPUT_WRITERS
+
+def finish_write(result: dict, write: Optional[Future]) -> dict:
+    """Wait for a result's background save, turning a failed write into a failed result."""
+    if write is not None:
+        try:
+            write.result()
+        except Exception as e:
+            return {"success": False, "error": f"Error saving {result['output_path']}: {str(e)}"}
+    return result
+
 def process_batch_images(input_dir: str, prompt: str, model: str,
                        strength: float, guidance_scale: float,
-                       num_steps: int) -> List[dict]:
-    """Process multiple images in a directory."""
+                       num_steps: int, batch_size: int = 1,
+                       quantize: str = "none") -> Iterator[dict]:
+    """Process multiple images in a directory, yielding a result per image as it finishes."""
+    image_files = []
+    writes = deque()
+    # Results handed to `writes` so far; later files were never attempted
+    queued = 0
     try:
         input_path = Path(input_dir)
         if not input_path.exists():
-            return [{"success": False, "error": f"Directory not found: {input_dir}"}]
+            yield {"success": False, "error": f"Directory not found: {input_dir}"}
+            return
             
-        # Find all image files
-        image_files = []
-        for ext in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp']:
-            image_files.extend(input_path.glob(f"*{ext}"))
-            image_files.extend(input_path.glob(f"*{ext.upper()}"))
+        # Find all image files in one directory pass
+        with os.scandir(input_path) as entries:
+            image_files = sorted(
+                Path(entry.path) for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+            )
             
         if not image_files:
-            return [{"success": False, "error": f"No image files found in {input_dir}"}]
+            yield {"success": False, "error": f"No image files found in {input_dir}"}
+            return
             
         print(f"Found {len(image_files)} images to process")
         
-        # Initialize generator
-        generator = ImageGenerator(model_name=model)
+        # Reuse the loaded generator for this model
+        generator = get_generator(model, quantize)
         
-        # Process each image
-        results = []
-        for i, image_file in enumerate(image_files, 1):
-            print(f"Processing {i}/{len(image_files)}: {image_file.name}")
-            
-            result = generator.generate(
-                input_image=str(image_file),
-                prompt=prompt,
-                strength=strength,
-                guidance_scale=guidance_scale,
-                num_inference_steps=num_steps
-            )
-            
-            results.append(result)
-            
-        return results
+        # Process the images in chunks of batch_size, decoding upcoming
+        # chunks on a thread pool while the current one is generating and
+        # encoding finished outputs on another, so neither blocks the GPU
+        from batch_pipeline import generate_batch, reserve_output_path, save_result
+        done = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as loader, \
+             ThreadPoolExecutor(max_workers=OUTPUT_WRITERS) as writer:
+            for chunk, images in prefetch_chunks(image_files, batch_size, loader):
+                print(f"Processing {done + 1}-{done + len(chunk)}/{len(image_files)}: "
+                      f"{', '.join(f.name for f in chunk)}")
+                done += len(chunk)
+                
+                loaded = [image for image in images if not isinstance(image, Exception)]
+                # Outputs are named after image_file's stem below, so the
+                # generator only needs the decoded pixels
+                generated = iter(generate_batch(
+                    generator, loaded, [prompt] * len(loaded),
+                    strength=strength,
+                    guidance_scale=guidance_scale,
+                    num_inference_steps=num_steps
+                ) if loaded else [])
+                results = [
+                    {"success": False, "error": f"Error loading {image_file.name}: {str(image)}"}
+                    if isinstance(image, Exception) else next(generated)
+                    for image_file, image in zip(chunk, images)
+                ]
+                for image_file, result in zip(chunk, results):
+                    write = None
+                    output = result.pop('generated_image', None)
+                    if result['success']:
+                        # Outputs come back unsaved; the writer owns the pixels from here on
+                        output_path = reserve_output_path(image_file.stem, model, prompt)
+                        result['output_path'] = str(output_path)
+                        write = writer.submit(save_result, output, output_path, result['metadata'])
+                    writes.append((result, write))
+                    queued += 1
+                    
+                # Hand back results in order as their writes complete
+                while writes and (writes[0][1] is None or writes[0][1].done()
+                                  or len(writes) > MAX_PENDING_WRITES):
+                    yield finish_write(*writes.popleft())
+                    
+            while writes:
+                yield finish_write(*writes.popleft())
         
     except Exception as e:
         logger.error(f"Error in batch processing: {str(e)}")
-        return [{"success": False, "error": str(e)}]
+        # Report what already finished, then every file the error cut off
+        while writes:
+            yield finish_write(*writes.popleft())
+        if not image_files:
+            yield {"success": False, "error": str(e)}
+        for image_file in image_files[queued:]:
+            yield {"success": False, "error": f"{image_file.name}: {str(e)}"}
+
+def download_model(model_name: str, load_lock: threading.Lock):
+    """Fetch one model's pipeline files into the Hugging Face cache."""
+    print(f"Downloading {model_name}...")
+    try:
+        # ImageGenerator loads from the config's model_id
+        config = MODEL_CONFIGS[model_name]
+        hub_id = config.get('model_id') or config.get('repo_id')
+        if hub_id:
+            # Only the files from_pretrained would load, not every checkpoint variant in the repo
+            from diffusers import DiffusionPipeline
+            DiffusionPipeline.download(hub_id)
+        else:
+            # No hub id in the config: load the model once so ImageGenerator
+            # fetches its own files, one pipeline in memory at a time
+            logger.warning(f"No model_id configured for {model_name}; "
+                           f"downloading it by loading the full pipeline instead")
+            from models.image_generator import ImageGenerator
+            with load_lock:
+                ImageGenerator(model_name=model_name)
+        print(f"✅ {model_name} downloaded successfully")
+    except Exception as e:
+        print(f"❌ Error downloading {model_name}: {str(e)}")
+
+def download_models():
+    """Download every model, fetching the repos in parallel."""
+    load_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=len(MODEL_CONFIGS) or 1) as pool:
+        list(pool.map(lambda model_name: download_model(model_name, load_lock), MODEL_CONFIGS))
 
 def list_models():
     """List available models."""
@@ -200,6 +335,10 @@ Examples:
                        help="Guidance scale for generation")
     parser.add_argument("--num-steps", type=int, default=50,
                        help="Number of inference steps")
+    parser.add_argument("--batch-size", type=int, default=1,
+                       help="Images per pipeline call when using --input-dir")
+    parser.add_argument("--quantize", type=str, default="none", choices=QUANTIZE_MODES,
+                       help="Quantize the UNet weights (requires optimum-quanto)")
     
     # Special commands
     parser.add_argument("--demo", action="store_true", help="Run demo examples")
@@ -219,19 +358,14 @@ Examples:
         return
         
     if args.cleanup:
+        from utils.image_utils import cleanup_old_results
         deleted_count = cleanup_old_results()
         print(f"🧹 Cleaned up {deleted_count} old result files")
         return
         
     if args.download_models:
         print("📥 Downloading models...")
-        for model_name in MODEL_CONFIGS.keys():
-            try:
-                print(f"Downloading {model_name}...")
-                generator = ImageGenerator(model_name=model_name)
-                print(f"✅ {model_name} downloaded successfully")
-            except Exception as e:
-                print(f"❌ Error downloading {model_name}: {str(e)}")
+        download_models()
         return
         
     if args.demo:
@@ -245,6 +379,9 @@ Examples:
     if not args.prompt:
         parser.error("--prompt is required")
         
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+        
     # Process images
     if args.input:
         print(f"🎨 Processing single image: {args.input}")
@@ -254,30 +391,37 @@ Examples:
             model=args.model,
             strength=args.strength,
             guidance_scale=args.guidance_scale,
-            num_steps=args.num_steps
+            num_steps=args.num_steps,
+            quantize=args.quantize
         )
         
         if result['success']:
-            print(f"✅ Generation successful!")
-            print(f"📁 Output: {result['output_path']}")
-            print(f"⏱️  Time: {result['metadata']['generation_time']:.2f}s")
+            print(RESULT_TMPL({**result['metadata'], 'output_path': result['output_path']}))
         else:
             print(f"❌ Generation failed: {result['error']}")
             sys.exit(1)
             
     elif args.input_dir:
         print(f"🎨 Processing batch images from: {args.input_dir}")
-        results = process_batch_images(
+        successful = total = 0
+        errors = []
+        for result in process_batch_images(
             input_dir=args.input_dir,
             prompt=args.prompt,
             model=args.model,
             strength=args.strength,
             guidance_scale=args.guidance_scale,
-            num_steps=args.num_steps
-        )
-        
-        successful = sum(1 for r in results if r['success'])
-        total = len(results)
+            num_steps=args.num_steps,
+            batch_size=args.batch_size,
+            quantize=args.quantize
+        ):
+            total += 1
+            successful += result['success']
+            if not result['success']:
+                errors.append(result['error'])
+            # PIL can hold on to decoded buffers; collect periodically on long runs
+            if total % GC_INTERVAL == 0:
+                gc.collect()
         
         print(f"\n📊 Batch processing completed:")
         print(f"✅ Successful: {successful}/{total}")
@@ -285,9 +429,8 @@ Examples:
         
         if successful < total:
             print("\nFailed generations:")
-            for result in results:
-                if not result['success']:
-                    print(f"  - {result['error']}")
+            for error in errors:
+                print(f"  - {error}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file